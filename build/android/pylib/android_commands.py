@@ -9,18 +9,25 @@ Assumes adb binary is currently on system path.
 
 import collections
 import datetime
+import hashlib
 import logging
+import mmap
 import os
 import re
+import select
 import shlex
+import sre_constants
+import sre_parse
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import cmd_helper
 import constants
 import io_stats_parser
+from utils import reraiser_thread
 try:
   import pexpect
 except:
@@ -42,12 +49,45 @@ PEXPECT_LINE_RE = re.compile('\n([^\r]*)\r')
 # appear at the start of any line of a command's output.
 SHELL_PROMPT = '~+~PQ\x17RS~+~'
 
+# Printed before and after each command run in the persistent adb shell (with
+# its exit code appended in the latter case). SHELL_PROMPT can't be used here
+# as its control character would be interpreted by the tty. The command line
+# spells the marker with an empty '' in the middle so that the tty echo of the
+# command never matches it.
+_SHELL_MARKER = '~+~PQRS~+~'
+_SHELL_MARKER_ARG = "~+~PQ''RS~+~"
+_SHELL_START_RE = re.compile(re.escape(_SHELL_MARKER) + '\r*\n')
+_SHELL_END_RE = re.compile(re.escape(_SHELL_MARKER) + '(\d+)\r*\n')
+# Upper bound on the length of a _SHELL_END_RE match.
+_SHELL_END_MAX_LENGTH = len(_SHELL_MARKER) + 32
+
+# Echoed with the exit code of commands run outside the persistent shell, see
+# GetShellCommandStatusAndOutput().
+_STATUS_MARKER = '__STATUS__'
+
+# Longer commands are sent through a new adb shell each time, to stay well
+# within the tty line length limit.
+_MAX_PERSISTENT_SHELL_COMMAND_LENGTH = 2048
+
+# Commands allowed to run longer than this (in seconds) are sent through a new
+# adb shell, as timing out in the persistent shell means respawning it.
+_MAX_PERSISTENT_SHELL_TIMEOUT = 60
+
 # Java properties file
 LOCAL_PROPERTIES_PATH = '/data/local.prop'
 
 # Property in /data/local.prop that controls Java assertions.
 JAVA_ASSERT_PROPERTY = 'dalvik.vm.enableassertions'
 
+# Matches a JAVA_ASSERT_PROPERTY line enabling assertions, and any line
+# setting it, respectively.
+_JAVA_ASSERT_SEARCH_RE = re.compile(
+    r'^\s*' + re.escape(JAVA_ASSERT_PROPERTY) + r'\s*=\s*all\s*$',
+    re.MULTILINE)
+_JAVA_ASSERT_REPLACE_RE = re.compile(
+    r'^\s*' + re.escape(JAVA_ASSERT_PROPERTY) + r'\s*=\s*\w+\s*$',
+    re.MULTILINE)
+
 MEMORY_INFO_RE = re.compile('^(?P<key>\w+):\s+(?P<usage_kb>\d+) kB$')
 NVIDIA_MEMORY_INFO_RE = re.compile('^\s*(?P<user>\S+)\s*(?P<name>\S+)\s*'
                                    '(?P<pid>\d+)\s*(?P<usage_bytes>\d+)$')
@@ -65,7 +105,76 @@ MD5SUM_DEVICE_FOLDER = constants.TEST_EXECUTABLE_DIR + '/md5sum/'
 MD5SUM_DEVICE_PATH = MD5SUM_DEVICE_FOLDER + 'md5sum_bin'
 MD5SUM_LD_LIBRARY_PATH = 'LD_LIBRARY_PATH=%s' % MD5SUM_DEVICE_FOLDER
 
-def GetEmulators():
+# Maximum number of parallel md5sum jobs when hashing a directory, on each of
+# the host and the device.
+_MD5SUM_MAX_JOBS = 4
+
+# Directories with more top level entries than this are hashed in a single
+# md5sum run, as running md5sum for each entry would cost more than it saves.
+_MD5SUM_MAX_PARALLEL_ENTRIES = 32
+
+# Maximum number of processes whose memory usage is read in parallel.
+_MEMORY_USAGE_MAX_THREADS = 8
+
+# `am start` flags for passing an extra of the given type, see StartActivity().
+_EXTRA_FLAG = {
+    str: '--es',
+    bool: '--ez',
+    int: '--ei',
+}
+
+# Echoed after each command by RunShellCommandBatch() to split the output.
+_BATCH_SEPARATOR = '~+~BATCH~+~'
+
+_EMULATOR_RE = re.compile('^emulator-[0-9]+', re.MULTILINE)
+_AVD_RE = re.compile('^[ ]+Name: ([a-zA-Z0-9_:.-]+)', re.MULTILINE)
+_DEVICE_RE = re.compile('^([a-zA-Z0-9_:.-]+)\tdevice$', re.MULTILINE)
+_ACTIVITY_STARTED_RE = re.compile('.*starting activity.*')
+# File lines of `ls -lR` output, see ListPathContents(). Example output:
+# /foo/bar:
+# -rw-r----- 1 user group   102 2011-05-12 12:29:54.131623387 +0100 baz.txt
+_LS_LR_RE = re.compile('^-(?P<perms>[^\s]+)\s+'
+                       '(?P<user>[^\s]+)\s+'
+                       '(?P<group>[^\s]+)\s+'
+                       '(?P<size>[^\s]+)\s+'
+                       '(?P<date>[^\s]+)\s+'
+                       '(?P<time>[^\s]+)\s+'
+                       '(?P<filename>[^\s]+)$')
+_LOGCAT_SEARCH_RE = re.compile(
+    '(\d+)\s+(\d+)\s+([A-Z])\s+([A-Za-z]+)\s*:(.*)$', re.MULTILINE)
+_MD5_HEAD_RE = re.compile('^([0-9a-f]{32})')
+_OUTPUT_LINE_RE = re.compile('([^\r\n]*)(?:\r\n|\r|\n|\Z)')
+# The lines of `getprop` output, e.g. "[ro.build.id]: [JRM79C]".
+_GETPROP_RE = re.compile('^\[([^\]]+)\]: \[(.*)\]$', re.MULTILINE)
+
+# Number of seconds for which the output of `adb devices` is reused.
+_ADB_DEVICES_CACHE_TTL = 1.0
+_adb_devices_cache = {'time': 0.0, 'output': None}
+_adb_devices_cache_lock = threading.Lock()
+
+
+def _GetAdbDevicesOutput(force=False):
+  """Returns the output of `adb devices`, reusing it for a short while.
+
+  Args:
+    force: If True, always run `adb devices` instead of reusing its output.
+  """
+  with _adb_devices_cache_lock:
+    if (force or _adb_devices_cache['output'] is None or
+        time.time() - _adb_devices_cache['time'] >= _ADB_DEVICES_CACHE_TTL):
+      _adb_devices_cache['output'] = cmd_helper.GetCmdOutput(
+          [constants.ADB_PATH, 'devices'])
+      _adb_devices_cache['time'] = time.time()
+    return _adb_devices_cache['output']
+
+
+def _ClearAdbDevicesCache():
+  """Forces the next call to _GetAdbDevicesOutput() to run `adb devices`."""
+  with _adb_devices_cache_lock:
+    _adb_devices_cache['output'] = None
+
+
+def GetEmulators(force=False):
   """Returns a list of emulators.  Does not filter by status (e.g. offline).
 
   Both devices starting with 'emulator' will be returned in below output:
@@ -76,21 +185,21 @@ def GetEmulators():
     027c10494100b4d7        device
     emulator-5554   offline
     emulator-5558   device
+
+  Args:
+    force: If True, bypass the cached `adb devices` output.
   """
-  re_device = re.compile('^emulator-[0-9]+', re.MULTILINE)
-  devices = re_device.findall(cmd_helper.GetCmdOutput([constants.ADB_PATH,
-                                                       'devices']))
+  devices = _EMULATOR_RE.findall(_GetAdbDevicesOutput(force))
   return devices
 
 
 def GetAVDs():
   """Returns a list of AVDs."""
-  re_avd = re.compile('^[ ]+Name: ([a-zA-Z0-9_:.-]+)', re.MULTILINE)
-  avds = re_avd.findall(cmd_helper.GetCmdOutput(['android', 'list', 'avd']))
+  avds = _AVD_RE.findall(cmd_helper.GetCmdOutput(['android', 'list', 'avd']))
   return avds
 
 
-def GetAttachedDevices():
+def GetAttachedDevices(force=False):
   """Returns a list of attached, online android devices.
 
   If a preferred device has been set with ANDROID_SERIAL, it will be first in
@@ -103,14 +212,14 @@ def GetAttachedDevices():
     List of devices attached
     027c10494100b4d7        device
     emulator-5554   offline
+
+  Args:
+    force: If True, bypass the cached `adb devices` output.
   """
-  re_device = re.compile('^([a-zA-Z0-9_:.-]+)\tdevice$', re.MULTILINE)
-  devices = re_device.findall(cmd_helper.GetCmdOutput([constants.ADB_PATH,
-                                                       'devices']))
+  devices = _DEVICE_RE.findall(_GetAdbDevicesOutput(force))
   preferred_device = os.environ.get('ANDROID_SERIAL')
   if preferred_device in devices:
-    devices.remove(preferred_device)
-    devices.insert(0, preferred_device)
+    devices = [preferred_device] + [d for d in devices if d != preferred_device]
   return devices
 
 
@@ -125,7 +234,7 @@ def _GetFilesFromRecursiveLsOutput(path, ls_output, re_file, utc_offset=None):
 
   Args:
     path: The path to list.
-    ls_output: A list of lines returned by an `ls -lR` command.
+    ls_output: An iterable over the lines returned by an `ls -lR` command.
     re_file: A compiled regular expression which parses a line into named groups
         consisting of at minimum "filename", "date", "time", "size" and
         optionally "timezone".
@@ -141,39 +250,146 @@ def _GetFilesFromRecursiveLsOutput(path, ls_output, re_file, utc_offset=None):
       size: The file size in bytes (0 for directories).
       lastmod: The file last modification date in UTC.
   """
-  re_directory = re.compile('^%s/(?P<dir>[^:]+):$' % re.escape(path))
   path_dir = os.path.dirname(path)
 
   current_dir = ''
   files = {}
+  re_ls = _GetRecursiveLsRe(path, re_file)
+  # Match each line once against both directory headers and file lines,
+  # without requiring the whole listing to be held in memory.
   for line in ls_output:
-    directory_match = re_directory.match(line)
-    if directory_match:
-      current_dir = directory_match.group('dir')
+    match = re_ls.match(line)
+    if not match:
+      continue
+    directory = match.group('dir')
+    if directory:
+      current_dir = directory
+      continue
+    filename = os.path.join(current_dir, match.group('filename'))
+    if filename.startswith(path_dir):
+      filename = filename[len(path_dir) + 1:]
+    # Dates are YYYY-MM-DD and times HH:MM[...]; slicing them is much cheaper
+    # than datetime.strptime().
+    date = match.group('date')
+    time_of_day = match.group('time')
+    lastmod = datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                int(time_of_day[0:2]), int(time_of_day[3:5]))
+    if not utc_offset and 'timezone' in re_file.groupindex:
+      utc_offset = match.group('timezone')
+    if isinstance(utc_offset, str) and len(utc_offset) == 5:
+      utc_delta = datetime.timedelta(hours=int(utc_offset[1:3]),
+                                     minutes=int(utc_offset[3:5]))
+      if utc_offset[0:1] == '-':
+        utc_delta = -utc_delta
+      lastmod -= utc_delta
+    files[filename] = (int(match.group('size')), lastmod)
+  return files
+
+
+def _GetFilesFromFindOutput(path, find_output):
+  """Gets a list of files from `find -printf "%s %T@ %p\\n"` command output.
+
+  Args:
+    path: The path to list.
+    find_output: An iterable over the lines returned by the `find` command.
+
+  Returns:
+    A dict of {"name": (size, lastmod), ...}, see
+    _GetFilesFromRecursiveLsOutput(). As with `ls -lR`, the names are relative
+    to |path|, or the basename of |path| if it is a file.
+  """
+  path_prefix = path.rstrip('/') + '/'
+
+  files = {}
+  for line in find_output:
+    items = line.split(None, 2)
+    if len(items) != 3:
       continue
-    file_match = re_file.match(line)
-    if file_match:
-      filename = os.path.join(current_dir, file_match.group('filename'))
-      if filename.startswith(path_dir):
-        filename = filename[len(path_dir) + 1:]
-      lastmod = datetime.datetime.strptime(
-          file_match.group('date') + ' ' + file_match.group('time')[:5],
-          '%Y-%m-%d %H:%M')
-      if not utc_offset and 'timezone' in re_file.groupindex:
-        utc_offset = file_match.group('timezone')
-      if isinstance(utc_offset, str) and len(utc_offset) == 5:
-        utc_delta = datetime.timedelta(hours=int(utc_offset[1:3]),
-                                       minutes=int(utc_offset[3:5]))
-        if utc_offset[0:1] == '-':
-          utc_delta = -utc_delta
-        lastmod -= utc_delta
-      files[filename] = (int(file_match.group('size')), lastmod)
+    size, timestamp, filename = items
+    try:
+      size = int(size)
+      # `ls -l` only has a one minute resolution, match it.
+      lastmod = datetime.datetime.utcfromtimestamp(
+          int(float(timestamp)) // 60 * 60)
+    except ValueError:
+      continue
+    if filename.startswith(path_prefix):
+      filename = filename[len(path_prefix):]
+    else:
+      filename = os.path.basename(filename)
+    files[filename] = (size, lastmod)
   return files
 
 
+def _GetRecursiveLsRe(path, re_file):
+  """Returns a re matching `ls -lR` directory header or file lines.
+
+  Args:
+    path: The listed path, directory headers are matched below it and captured
+        in the "dir" group.
+    re_file: A compiled regular expression matching a single file line, see
+        _GetFilesFromRecursiveLsOutput().
+  """
+  # re.compile() caches its recent results, so listing the same path again
+  # doesn't recompile the pattern.
+  return re.compile('^(?:%s/(?P<dir>[^:]+):|%s)$' % (re.escape(path),
+                                                     re_file.pattern),
+                    re_file.flags)
+
+
+def _IterLines(output):
+  """Yields the lines of |output|, splitting it like str.splitlines() does."""
+  for match in _OUTPUT_LINE_RE.finditer(output):
+    # Only the match at the very end of |output| can be empty.
+    if match.start() == match.end():
+      break
+    yield match.group(1)
+
+
+def _LiteralAnchor(compiled_re):
+  """Returns a string which any match of |compiled_re| must contain.
+
+  This is the longest run of plain characters the pattern requires, or '' if
+  there is none, e.g. '**PERF(' for re.compile('\*\*PERF\((.*)\)'). Checking
+  for it with "in" is a lot cheaper than searching the pattern.
+  """
+  if compiled_re.flags & re.IGNORECASE:
+    return ''
+  anchors = ['']
+  run = []
+  # Only the top level items of the pattern are all required, in order.
+  for op, av in sre_parse.parse(compiled_re.pattern, compiled_re.flags):
+    if op == sre_constants.LITERAL and av < 128:
+      run.append(chr(av))
+    elif run:
+      anchors.append(''.join(run))
+      run = []
+  anchors.append(''.join(run))
+  return max(anchors, key=len)
+
+
 def _ComputeFileListHash(md5sum_output):
-  """Returns a list of MD5 strings from the provided md5sum output."""
-  return [line.split('  ')[0] for line in md5sum_output]
+  """Returns a list of MD5 strings from the provided md5sum output lines."""
+  hashes = []
+  for line in md5sum_output:
+    match = _MD5_HEAD_RE.match(line)
+    if match:
+      hashes.append(match.group(1))
+  return hashes
+
+
+def _ComputeFileMd5(file_path):
+  """Returns the MD5 string of the contents of the host file |file_path|."""
+  md5 = hashlib.md5()
+  with open(file_path, 'rb') as f:
+    # Empty files can't be mapped.
+    if os.fstat(f.fileno()).st_size:
+      contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        md5.update(contents)
+      finally:
+        contents.close()
+  return md5.hexdigest()
 
 
 def _HasAdbPushSucceeded(command_output):
@@ -184,7 +400,13 @@ def _HasAdbPushSucceeded(command_output):
     return True
   # Success looks like this: "3035 KB/s (12512056 bytes in 4.025s)"
   # Errors look like this: "failed to copy  ... "
-  if not re.search('^[0-9]', command_output.splitlines()[-1]):
+  # Only look at the last line, without splitting the whole output.
+  end = len(command_output)
+  while end and command_output[end - 1] in '\r\n':
+    end -= 1
+  start = max(command_output.rfind('\n', 0, end),
+              command_output.rfind('\r', 0, end)) + 1
+  if not command_output[start:end][:1].isdigit():
     logging.critical('PUSH FAILED: ' + command_output)
     return False
   return True
@@ -192,6 +414,14 @@ def _HasAdbPushSucceeded(command_output):
 
 def GetLogTimestamp(log_line, year):
   """Returns the timestamp of the given |log_line| in the given year."""
+  # Logcat lines start with "MM-DD HH:MM:SS.mmm", slicing them is much cheaper
+  # than datetime.strptime(), which is only used for anything unexpected.
+  try:
+    return datetime.datetime(int(year), int(log_line[0:2]), int(log_line[3:5]),
+                             int(log_line[6:8]), int(log_line[9:11]),
+                             int(log_line[12:14]), int(log_line[15:18]) * 1000)
+  except ValueError:
+    pass
   try:
     return datetime.datetime.strptime('%s-%s' % (year, log_line[:18]),
                                       '%Y-%m-%d %H:%M:%S.%f')
@@ -200,6 +430,157 @@ def GetLogTimestamp(log_line, year):
     return None
 
 
+class _PersistentShell(object):
+  """An adb shell kept open to run successive commands in.
+
+  Args:
+    adb_args: List of arguments for adb preceding "shell", e.g. to select the
+        device.
+  """
+
+  def __init__(self, adb_args):
+    self._adb_args = adb_args
+    self._shell = None
+    self._lock = threading.Lock()
+
+  def _Close(self):
+    if self._shell:
+      self._shell.close(force=True)
+      self._shell = None
+
+  def Close(self):
+    """Terminates the shell, if it is running. It is respawned when needed."""
+    with self._lock:
+      self._Close()
+
+  def Run(self, command, timeout_time):
+    """Runs a command in the shell, spawning it if needed.
+
+    Args:
+      command: String containing the shell command to run.
+      timeout_time: Number of seconds to wait for the command to complete.
+
+    Returns:
+      The tuple (exit code, output string), or None if the command could not be
+      run in the shell.
+    """
+    # Commands that can't be wrapped on a single tty line are left to a new
+    # adb shell.
+    # The pylib pexpect wrapper is importable even when pexpect itself isn't.
+    if (not getattr(pexpect, 'spawn', None) or '\n' in command or
+        '#' in command or len(command) > _MAX_PERSISTENT_SHELL_COMMAND_LENGTH):
+      return None
+    with self._lock:
+      try:
+        if not self._shell:
+          self._shell = pexpect.spawn(constants.ADB_PATH,
+                                      self._adb_args + ['shell'],
+                                      maxread=65536)
+        # The subshell keeps commands from changing each other's environment,
+        # and from consuming the following commands as their input.
+        self._shell.sendline('echo %s; (%s) </dev/null; echo %s$?' %
+                             (_SHELL_MARKER_ARG, command, _SHELL_MARKER_ARG))
+        self._shell.expect(_SHELL_START_RE, timeout=timeout_time)
+        return self._ReadToEndMarker(timeout_time)
+      except (pexpect.ExceptionPexpect, OSError):
+        logging.warning('Persistent adb shell failed, running %s in a new one',
+                        command)
+        self._Close()
+        return None
+
+  def _ReadToEndMarker(self, timeout_time):
+    """Reads the output of the running command, up to _SHELL_END_RE.
+
+    Unlike expect(), which searches and copies the whole output received so
+    far after each read, only the new data is searched, together with the end
+    of the previous data in case the marker was split.
+
+    Returns:
+      The tuple (exit code, output string).
+    """
+    end_time = time.time() + timeout_time
+    chunks = []
+    tail = ''
+    data = self._shell.buffer
+    self._shell.buffer = ''
+    while True:
+      window = tail + data
+      match = _SHELL_END_RE.search(window)
+      if match:
+        output = ''.join(chunks) + data
+        offset = len(output) - len(window)
+        self._shell.buffer = output[offset + match.end():]
+        return (int(match.group(1)), output[:offset + match.start()])
+      chunks.append(data)
+      tail = window[-_SHELL_END_MAX_LENGTH:]
+      time_remaining = end_time - time.time()
+      if time_remaining < 0:
+        raise pexpect.TIMEOUT('Timeout exceeded waiting for the shell.')
+      data = self._shell.read_nonblocking(self._shell.maxread, time_remaining)
+
+
+class _LogcatReader(object):
+  """Reads the lines of an "adb logcat" process as they are logged.
+
+  Args:
+    args: List of arguments for adb.
+    logfile: Optional file-like object to copy the lines to.
+  """
+
+  def __init__(self, args, logfile=None):
+    self.args = args
+    self.logfile = logfile
+    self._process = subprocess.Popen([constants.ADB_PATH] + args,
+                                     stdout=subprocess.PIPE)
+    self._partial_line = ''
+    self._lines = collections.deque()
+
+  def Close(self):
+    """Terminates the logcat process."""
+    if self._process.poll() is None:
+      self._process.kill()
+    self._process.wait()
+    self._process.stdout.close()
+
+  def ReadLine(self, timeout):
+    """Returns the next line of logcat output, without its line terminator.
+
+    Args:
+      timeout: Number of seconds to wait for a complete line.
+
+    Returns:
+      The line, or None once logcat has exited.
+
+    Raises:
+      errors.WaitForResponseTimedOutError if no line came within |timeout|.
+    """
+    deadline = time.time() + timeout
+    fd = self._process.stdout.fileno()
+    while not self._lines:
+      time_remaining = deadline - time.time()
+      if time_remaining < 0:
+        raise errors.WaitForResponseTimedOutError(
+            'No logcat output after %ss' % timeout)
+      if not select.select([fd], [], [], time_remaining)[0]:
+        continue
+      # Unlike readline(), os.read() returns whatever is available at once.
+      data = os.read(fd, 65536)
+      if not data:
+        if not self._partial_line:
+          return None
+        data = '\n'
+      lines = (self._partial_line + data).split('\n')
+      self._partial_line = lines.pop()
+      for line in lines:
+        line = line.rstrip('\r')
+        if self.logfile:
+          self.logfile.write(line + '\n')
+        self._lines.append(line)
+      if self.logfile:
+        self.logfile.flush()
+    return self._lines.popleft()
+
+
 class AndroidCommands(object):
   """Helper class for communicating with Android device via adb.
 
@@ -208,18 +589,24 @@ class AndroidCommands(object):
         Otherwise commands are sent to all attached devices.
   """
 
+  # Whether the adb directory has been checked for in $PATH yet.
+  _path_patched = False
+
   def __init__(self, device=None):
-    adb_dir = os.path.dirname(constants.ADB_PATH)
-    if adb_dir and adb_dir not in os.environ['PATH'].split(os.pathsep):
-      # Required by third_party/android_testrunner to call directly 'adb'.
-      os.environ['PATH'] += os.pathsep + adb_dir
+    if not AndroidCommands._path_patched:
+      adb_dir = os.path.dirname(constants.ADB_PATH)
+      if adb_dir and adb_dir not in os.environ['PATH'].split(os.pathsep):
+        # Required by third_party/android_testrunner to call directly 'adb'.
+        os.environ['PATH'] += os.pathsep + adb_dir
+      AndroidCommands._path_patched = True
     self._adb = adb_interface.AdbInterface()
     if device:
       self._adb.SetTargetSerial(device)
     self._device = device
     self._logcat = None
     self.logcat_process = None
-    self._logcat_tmpoutfile = None
+    self._logcat_output = None
+    self._logcat_reader = None
     self._pushed_files = []
     self._device_utc_offset = None
     self._potential_push_size = 0
@@ -227,6 +614,15 @@ class AndroidCommands(object):
     self._md5sum_build_dir = ''
     self._external_storage = ''
     self._util_wrapper = ''
+    adb_args = []
+    if self._adb._target_arg:
+      adb_args = shlex.split(self._adb._target_arg)
+    self._shell = _PersistentShell(adb_args)
+    self._is_root_enabled = None
+    self._all_props = None
+    self._has_grep = None
+    self._has_test = None
+    self._has_find_printf = None
 
   def _LogShell(self, cmd):
     """Logs the adb shell command."""
@@ -251,8 +647,10 @@ class AndroidCommands(object):
 
   def IsRootEnabled(self):
     """Checks if root is enabled on the device."""
-    root_test_output = self.RunShellCommand('ls /root') or ['']
-    return not 'Permission denied' in root_test_output[0]
+    if self._is_root_enabled is None:
+      root_test_output = self.RunShellCommand('ls /root') or ['']
+      self._is_root_enabled = not 'Permission denied' in root_test_output[0]
+    return self._is_root_enabled
 
   def EnableAdbRoot(self):
     """Enables adb root on the device.
@@ -265,6 +663,9 @@ class AndroidCommands(object):
       logging.warning("Can't enable root in production builds with type user")
       return False
     else:
+      # adbd restarts, which terminates the persistent shell.
+      self._shell.Close()
+      self._is_root_enabled = None
       return_value = self._adb.EnableAdbRoot()
       # EnableAdbRoot inserts a call for wait-for-device only when adb logcat
       # output matches what is expected. Just to be safe add a call to
@@ -321,11 +722,14 @@ class AndroidCommands(object):
       logging.warning('Ignoring reboot request as we are on hive')
       return
     if full_reboot or not self.IsRootEnabled():
+      self._shell.Close()
       self._adb.SendCommand('reboot')
       timeout = 300
     else:
       self.RestartShell()
       timeout = 120
+    self._is_root_enabled = None
+    self._all_props = None
     # To run tests we need at least the package manager and the sd card (or
     # other external storage) to be ready.
     self.WaitForDevicePm()
@@ -358,13 +762,10 @@ class AndroidCommands(object):
     assert os.path.isfile(package_file_path), ('<%s> is not file' %
                                                package_file_path)
 
-    install_cmd = ['install']
-
     if reinstall:
-      install_cmd.append('-r')
-
-    install_cmd.append(package_file_path)
-    install_cmd = ' '.join(install_cmd)
+      install_cmd = 'install -r ' + package_file_path
+    else:
+      install_cmd = 'install ' + package_file_path
 
     self._LogShell(install_cmd)
     # FIXME(wang16): Change the timeout here to five minutes. Revert
@@ -421,6 +822,8 @@ class AndroidCommands(object):
 
   def KillAdbServer(self):
     """Kill adb server."""
+    _ClearAdbDevicesCache()
+    self._shell.Close()
     adb_cmd = [constants.ADB_PATH, 'kill-server']
     return cmd_helper.RunCmd(adb_cmd)
 
@@ -444,9 +847,11 @@ class AndroidCommands(object):
     # Now the device is there, but system not boot completed.
     # Query the sys.boot_completed flag with a basic command
     boot_completed = False
-    attempts = 0
-    wait_period = 5
-    while not boot_completed and (attempts * wait_period) < wait_time:
+    deadline = time.time() + wait_time
+    # Poll quickly at first, backing off exponentially up to max_period.
+    wait_period = 0.25
+    max_period = 2.0
+    while not boot_completed and time.time() < deadline:
       output = self._adb.SendShellCommand('getprop sys.boot_completed',
                                           retry_count=1)
       output = output.strip()
@@ -455,11 +860,12 @@ class AndroidCommands(object):
       else:
         # If 'error: xxx' returned when querying the flag, it means
         # adb server lost the connection to the emulator, so restart the adb
-        # server.
+        # server, and give it some time before querying again.
         if 'error:' in output:
           self.RestartAdbServer()
-        time.sleep(wait_period)
-        attempts += 1
+          wait_period = max(wait_period, 5)
+        time.sleep(max(0, min(wait_period, deadline - time.time())))
+        wait_period = min(wait_period * 1.5, max_period)
     if not boot_completed:
       raise errors.WaitForResponseTimedOutError(
           'sys.boot_completed flag was not set after %s seconds' % wait_time)
@@ -468,20 +874,70 @@ class AndroidCommands(object):
     """Wait for the SD card ready before pushing data into it."""
     logging.info('Waiting for SD card ready...')
     sdcard_ready = False
-    attempts = 0
-    wait_period = 5
+    deadline = time.time() + timeout_time
+    # Poll quickly at first, backing off exponentially up to max_period.
+    wait_period = 0.25
+    max_period = 2.0
     external_storage = self.GetExternalStorage()
-    while not sdcard_ready and attempts * wait_period < timeout_time:
+    while not sdcard_ready and time.time() < deadline:
       output = self.RunShellCommand('ls ' + external_storage)
       if output:
         sdcard_ready = True
       else:
-        time.sleep(wait_period)
-        attempts += 1
+        time.sleep(max(0, min(wait_period, deadline - time.time())))
+        wait_period = min(wait_period * 1.5, max_period)
     if not sdcard_ready:
       raise errors.WaitForResponseTimedOutError(
           'SD card not ready after %s seconds' % timeout_time)
 
+  def _GetShellCommandOutput(self, command, timeout_time, get_status):
+    """Runs |command| in the adb shell.
+
+    Returns:
+      The tuple (exit code, output string). The exit code is None if the command
+      didn't run in the persistent shell, in which case its output ends with
+      _STATUS_MARKER and the exit code if |get_status| is True.
+    """
+    self._LogShell(command)
+    persistent_result = None
+    # su may wait for access to be granted on the device, which would hold up
+    # every other command in the persistent shell.
+    if (timeout_time <= _MAX_PERSISTENT_SHELL_TIMEOUT and
+        not command.startswith('su ')):
+      persistent_result = self._shell.Run(command, timeout_time)
+    if persistent_result:
+      status, output = persistent_result
+      # The local pty may add a '\r' of its own to the device's line endings.
+      return (status, output.replace('\r\r\n', '\n'))
+    if get_status:
+      command += '; echo %s$?' % _STATUS_MARKER
+    if "'" in command: logging.warning(command + " contains ' quotes")
+    return (None, self._adb.SendShellCommand("'%s'" % command, timeout_time))
+
+  def _RunShellCommand(self, command, timeout_time, log_result, get_status):
+    """Implements RunShellCommand() and GetShellCommandStatusAndOutput().
+
+    Returns:
+      The tuple (exit code, list of output lines). The exit code is None if
+      |get_status| is False and the command didn't run in the persistent shell.
+    """
+    status, output = self._GetShellCommandOutput(command, timeout_time,
+                                                 get_status)
+    lines = output.splitlines()
+    if ['error: device not found'] == lines:
+      raise errors.DeviceUnresponsiveError('device not found')
+    if get_status and status is None:
+      status_pos = lines[-1].rfind(_STATUS_MARKER) if lines else -1
+      if status_pos < 0:
+        raise ValueError('No exit status in output of: %s' % command)
+      last_line = lines.pop()
+      status = int(last_line[status_pos + len(_STATUS_MARKER):])
+      if status_pos:
+        lines.append(last_line[:status_pos])
+    if log_result:
+      self._LogShell('\n'.join(lines))
+    return (status, lines)
+
   # It is tempting to turn this function into a generator, however this is not
   # possible without using a private (local) adb_shell instance (to ensure no
   # other command interleaves usage of it), which would defeat the main aim of
@@ -489,6 +945,9 @@ class AndroidCommands(object):
   def RunShellCommand(self, command, timeout_time=20, log_result=False):
     """Send a command to the adb shell and return the result.
 
+    Commands are run in a persistent adb shell when possible, to save setting
+    up a new adb connection each time.
+
     Args:
       command: String containing the shell command to send. Must not include
                the single quotes as we use them to escape the whole command.
@@ -500,15 +959,88 @@ class AndroidCommands(object):
     Returns:
       list containing the lines of output received from running the command
     """
-    self._LogShell(command)
-    if "'" in command: logging.warning(command + " contains ' quotes")
-    result = self._adb.SendShellCommand(
-        "'%s'" % command, timeout_time).splitlines()
-    if ['error: device not found'] == result:
+    return self._RunShellCommand(command, timeout_time, log_result, False)[1]
+
+  def RunShellCommandIter(self, command, timeout_time=20):
+    """Like RunShellCommand(), but returns an iterator over the output lines.
+
+    The command still completes before this returns, only the splitting of its
+    output is deferred so that large outputs aren't copied into a list.
+    """
+    output = self._GetShellCommandOutput(command, timeout_time, False)[1]
+    if output.rstrip('\r\n') == 'error: device not found':
       raise errors.DeviceUnresponsiveError('device not found')
-    if log_result:
-      self._LogShell('\n'.join(result))
-    return result
+    return _IterLines(output)
+
+  def RunShellCommandStream(self, command, timeout_time=60):
+    """Yields the output lines of a shell command as they are received.
+
+    Unlike RunShellCommand(), the command runs in an adb shell of its own and
+    its output is never held in memory all at once.
+
+    Args:
+      command: String containing the shell command to send.
+      timeout_time: Number of seconds after which the command is killed.
+
+    Raises:
+      errors.WaitForResponseTimedOutError if the command was killed.
+      errors.DeviceUnresponsiveError if the device was not found.
+    """
+    self._LogShell(command)
+    args = [constants.ADB_PATH]
+    if self._adb._target_arg:
+      args += shlex.split(self._adb._target_arg)
+    args += ['shell', command]
+    # adb reports its own errors, such as a missing device, on stderr.
+    adb = subprocess.Popen(args, stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+    timer = threading.Timer(timeout_time, adb.kill)
+    timer.start()
+    try:
+      first_line = True
+      for line in iter(adb.stdout.readline, ''):
+        line = line.rstrip('\r\n')
+        if first_line and line == 'error: device not found':
+          raise errors.DeviceUnresponsiveError('device not found')
+        first_line = False
+        yield line
+    finally:
+      timer.cancel()
+      if adb.poll() is None:
+        adb.kill()
+      adb.wait()
+    if adb.returncode < 0:
+      raise errors.WaitForResponseTimedOutError(
+          'Timed out after %ss running %s' % (timeout_time, command))
+
+  def RunShellCommandBatch(self, commands, timeout_time=20, log_result=False):
+    """Sends several commands to the adb shell in a single round trip.
+
+    Args:
+      commands: List of shell command strings, see RunShellCommand() above.
+      timeout_time: Number of seconds to wait for all the commands to respond.
+      log_result: Boolean to indicate whether we should log the result of the
+                  shell commands.
+
+    Returns:
+      A list with, for each command, the list of its output lines.
+    """
+    batch = ' '.join('%s; echo %s;' % (command, _BATCH_SEPARATOR)
+                     for command in commands)
+    results = []
+    current_output = []
+    for line in self.RunShellCommand(batch, timeout_time, log_result):
+      separator_pos = line.rfind(_BATCH_SEPARATOR)
+      if separator_pos < 0:
+        current_output.append(line)
+        continue
+      # The separator may follow output that didn't end with a newline.
+      if separator_pos > 0:
+        current_output.append(line[:separator_pos])
+      results.append(current_output)
+      current_output = []
+    assert len(results) == len(commands), 'Batched shell output was truncated'
+    return results
 
   def GetShellCommandStatusAndOutput(self, command, timeout_time=20,
                                      log_result=False):
@@ -517,17 +1049,7 @@ class AndroidCommands(object):
     Returns:
       The tuple (exit code, list of output lines).
     """
-    lines = self.RunShellCommand(
-        command + '; echo %$?', timeout_time, log_result)
-    last_line = lines[-1]
-    status_pos = last_line.rfind('%')
-    assert status_pos >= 0
-    status = int(last_line[status_pos + 1:])
-    if status_pos == 0:
-      lines = lines[:-1]
-    else:
-      lines = lines[:-1] + [last_line[:status_pos]]
-    return (status, lines)
+    return self._RunShellCommand(command, timeout_time, log_result, True)
 
   def KillAll(self, process):
     """Android version of killall, connected via adb.
@@ -577,33 +1099,28 @@ class AndroidCommands(object):
     Returns:
       the command to run on the target to start the activity
     """
-    cmd = 'am start -a %s' % action
+    cmd = ['am start -a', action]
     if force_stop:
-      cmd += ' -S'
+      cmd.append('-S')
     if wait_for_completion:
-      cmd += ' -W'
+      cmd.append('-W')
     if category:
-      cmd += ' -c %s' % category
+      cmd += ['-c', category]
     if package and activity:
-      cmd += ' -n %s/%s' % (package, activity)
+      cmd += ['-n', '%s/%s' % (package, activity)]
     if data:
-      cmd += ' -d "%s"' % data
+      cmd += ['-d', '"%s"' % data]
     if extras:
       for key in extras:
         value = extras[key]
-        if isinstance(value, str):
-          cmd += ' --es'
-        elif isinstance(value, bool):
-          cmd += ' --ez'
-        elif isinstance(value, int):
-          cmd += ' --ei'
-        else:
+        flag = _EXTRA_FLAG.get(type(value))
+        if not flag:
           raise NotImplementedError(
               'Need to teach StartActivity how to pass %s extras' % type(value))
-        cmd += ' %s %s' % (key, value)
+        cmd += [flag, key, str(value)]
     if trace_file_name:
-      cmd += ' --start-profiler ' + trace_file_name
-    return cmd
+      cmd += ['--start-profiler', trace_file_name]
+    return ' '.join(cmd)
 
   def StartActivity(self, package, activity, wait_for_completion=False,
                     action='android.intent.action.VIEW',
@@ -646,12 +1163,12 @@ class AndroidCommands(object):
                                    action, category, data, extras,
                                    trace_file_name, force_stop)
     self.StartMonitoringLogcat()
-    self.RunShellCommand('log starting activity; ' + cmd)
-    activity_started_re = re.compile('.*starting activity.*')
-    m = self.WaitForLogMatch(activity_started_re, None)
+    # Read the device year in the same round trip, see GetDeviceYear().
+    year = self.RunShellCommand('date +%Y; log starting activity; ' + cmd)[0]
+    m = self.WaitForLogMatch(_ACTIVITY_STARTED_RE, None)
     assert m
     start_line = m.group(0)
-    return GetLogTimestamp(start_line, self.GetDeviceYear())
+    return GetLogTimestamp(start_line, year)
 
   def GoHome(self):
     """Tell the device to return to the home screen. Blocks until completion."""
@@ -708,38 +1225,95 @@ class AndroidCommands(object):
     Args:
       local_path: Path (file or directory) on the host.
       device_path: Path on the device.
-      ignore_paths: If False, both the md5sum and the relative paths/names of
-          files must match. If True, only the md5sum must match.
+      ignore_paths: Kept for compatibility. Only the md5sums are compared,
+          whether or not the relative paths/names of files match.
 
     Returns:
       True if the md5sums match.
     """
     if not self._md5sum_build_dir:
       default_build_type = os.environ.get('BUILD_TYPE', 'Debug')
-      build_dir = '%s/%s/' % (
-          cmd_helper.OutDirectory().get(), default_build_type)
+      out_dir = cmd_helper.OutDirectory().get()
+      build_dir = '%s/%s/' % (out_dir, default_build_type)
       md5sum_dist_path = '%s/md5sum_dist' % build_dir
       if not os.path.exists(md5sum_dist_path):
-        build_dir = '%s/Release/' % cmd_helper.OutDirectory().get()
+        build_dir = '%s/Release/' % out_dir
         md5sum_dist_path = '%s/md5sum_dist' % build_dir
         assert os.path.exists(md5sum_dist_path), 'Please build md5sum.'
       command = 'push %s %s' % (md5sum_dist_path, MD5SUM_DEVICE_FOLDER)
       assert _HasAdbPushSucceeded(self._adb.SendCommand(command))
       self._md5sum_build_dir = build_dir
 
-    hashes_on_device = _ComputeFileListHash(
-        self.RunShellCommand(MD5SUM_LD_LIBRARY_PATH + ' ' + self._util_wrapper +
-            ' ' + MD5SUM_DEVICE_PATH + ' ' + device_path))
     assert os.path.exists(local_path), 'Local path not found %s' % local_path
-    md5sum_output = cmd_helper.GetCmdOutput(
-        ['%s/md5sum_bin_host' % self._md5sum_build_dir, local_path])
-    hashes_on_host = _ComputeFileListHash(md5sum_output.splitlines())
-
-    if ignore_paths:
-      hashes_on_device = [h.split()[0] for h in hashes_on_device]
-      hashes_on_host = [h.split()[0] for h in hashes_on_host]
-
-    return hashes_on_device == hashes_on_host
+    md5sum_device_cmd = '%s %s %s' % (MD5SUM_LD_LIBRARY_PATH,
+                                      self._util_wrapper, MD5SUM_DEVICE_PATH)
+    entries = []
+    if os.path.isdir(local_path):
+      entries = sorted(os.listdir(local_path))
+    # Only hash the top level entries in parallel when there are several
+    # subdirectories to walk, and the names can be double quoted on the device.
+    subdirs = [entry for entry in entries
+               if os.path.isdir(os.path.join(local_path, entry))]
+    if (len(subdirs) < 2 or len(entries) > _MD5SUM_MAX_PARALLEL_ENTRIES or
+        re.search(r'["$`\\]', ''.join(entries) + device_path)):
+      # Start hashing the host directory first, so that it overlaps with the
+      # round trip to the device.
+      host_md5sum = None
+      if entries:
+        host_md5sum = subprocess.Popen(
+            ['%s/md5sum_bin_host' % self._md5sum_build_dir, local_path],
+            stdout=subprocess.PIPE)
+      hashes_on_device = _ComputeFileListHash(self.RunShellCommandIter(
+          md5sum_device_cmd + ' ' + device_path))
+      if os.path.isfile(local_path):
+        # Single files are hashed in-process rather than with md5sum_bin_host.
+        return hashes_on_device == [_ComputeFileMd5(local_path)]
+      if not host_md5sum:
+        return not hashes_on_device
+      hashes_on_host = _ComputeFileListHash(
+          host_md5sum.communicate()[0].splitlines())
+      return hashes_on_device == hashes_on_host
+
+    # Hash the top level entries of the directory in up to _MD5SUM_MAX_JOBS
+    # parallel jobs on both the host and the device. The host jobs are started
+    # first so that they overlap with the round trip to the device.
+    chunk_size = (len(entries) + _MD5SUM_MAX_JOBS - 1) / _MD5SUM_MAX_JOBS
+    chunks = [entries[i:i + chunk_size]
+              for i in xrange(0, len(entries), chunk_size)]
+    host_jobs = []
+    for chunk in chunks:
+      host_output = tempfile.TemporaryFile()
+      host_jobs.append((subprocess.Popen(
+          ['sh', '-c', 'for p; do "$0" "$p"; done',
+           '%s/md5sum_bin_host' % self._md5sum_build_dir] +
+          [os.path.join(local_path, entry) for entry in chunk],
+          stdout=host_output), host_output))
+    device_jobs = []
+    device_outputs = []
+    for i, chunk in enumerate(chunks):
+      device_output = '%smd5sum_out_$$_%d' % (MD5SUM_DEVICE_FOLDER, i)
+      device_jobs.append('(for p in %s; do %s "$p"; done) > %s &' % (
+          ' '.join('"%s/%s"' % (device_path, entry) for entry in chunk),
+          md5sum_device_cmd, device_output))
+      device_outputs.append(device_output)
+    device_outputs = ' '.join(device_outputs)
+    # Also list the device directory, one name per line, as extra entries
+    # there wouldn't be hashed otherwise.
+    device_entries, device_md5sum_output = self.RunShellCommandBatch(
+        ['(cd "%s" && for f in * .*; do echo "$f"; done)' % device_path,
+         '%s wait; cat %s; rm %s' % (' '.join(device_jobs), device_outputs,
+                                     device_outputs)])
+    hashes_on_device = _ComputeFileListHash(device_md5sum_output)
+
+    hashes_on_host = []
+    for host_md5sum, host_output in host_jobs:
+      host_md5sum.wait()
+      host_output.seek(0)
+      hashes_on_host += _ComputeFileListHash(host_output.read().splitlines())
+      host_output.close()
+    device_entries = set(device_entries) - set(['.', '..'])
+    return (device_entries == set(entries) and
+            hashes_on_device == hashes_on_host)
 
   def PushIfNeeded(self, local_path, device_path):
     """Pushes |local_path| to |device_path|.
@@ -750,18 +1324,21 @@ class AndroidCommands(object):
     All pushed files can be removed by calling RemovePushedFiles().
     """
     assert os.path.exists(local_path), 'Local path not found %s' % local_path
-    size = int(cmd_helper.GetCmdOutput(['du', '-sb', local_path]).split()[0])
+    # Measure the size on the host while the md5sums are being compared.
+    du = subprocess.Popen(['du', '-sb', local_path], stdout=subprocess.PIPE)
+    md5sum_matches = self.CheckMd5Sum(local_path, device_path)
+    size = int(du.communicate()[0].split()[0])
     self._pushed_files.append(device_path)
     self._potential_push_size += size
 
-    if self.CheckMd5Sum(local_path, device_path):
+    if md5sum_matches:
       return
 
     self._actual_push_size += size
     # They don't match, so remove everything first and then create it.
     if os.path.isdir(local_path):
-      self.RunShellCommand('rm -r %s' % device_path, timeout_time=2 * 60)
-      self.RunShellCommand('mkdir -p %s' % device_path)
+      self.RunShellCommand('rm -r %s; mkdir -p %s' % (device_path, device_path),
+                           timeout_time=2 * 60)
 
     # NOTE: We can't use adb_interface.Push() because it hardcodes a timeout of
     # 60 seconds which isn't sufficient for a lot of users of this method.
@@ -796,10 +1373,20 @@ class AndroidCommands(object):
   _TEMP_SCRIPT_FILE_BASE_FMT = 'temp_script_file_%d.sh'
 
   def _GetDeviceTempFileName(self, base_name):
+    """Returns a path in external storage not used by any existing file.
+
+    Args:
+      base_name: File name format with a single %d for a numeric suffix.
+    """
+    re_temp_file = re.compile(
+        '^%s$' % re.escape(base_name).replace(re.escape('%d'), '(\\d+)'))
+    # List the directory once rather than probing each candidate name.
     i = 0
-    while self.FileExistsOnDevice(
-        self.GetExternalStorage() + '/' + base_name % i):
-      i += 1
+    for line in self.RunShellCommand('ls ' + self.GetExternalStorage()):
+      for name in line.split():
+        match = re_temp_file.match(name)
+        if match:
+          i = max(i, int(match.group(1)) + 1)
     return self.GetExternalStorage() + '/' + base_name % i
 
   def CanAccessProtectedFileContents(self):
@@ -832,18 +1419,26 @@ class AndroidCommands(object):
 
     # Put the contents in a temporary file
     self.SetFileContents(temp_file, contents)
-    # Create a script to copy the file contents to its final destination
+    # Create a script to copy the file contents to its final destination. The
+    # debug su runs the words after -c as a program, there is no shell to
+    # handle a redirection.
     self.SetFileContents(temp_script, 'cat %s > %s' % (temp_file, filename))
-    # Run the script as root
-    self.RunShellCommand('su -c sh %s' % temp_script)
-    # And remove the temporary files
-    self.RunShellCommand('rm ' + temp_file)
-    self.RunShellCommand('rm ' + temp_script)
+    # Run the script as root and remove the temporary files, in one go.
+    self.RunShellCommand('su -c sh %s; rm %s %s' %
+                         (temp_script, temp_file, temp_script))
 
   def RemovePushedFiles(self):
     """Removes all files pushed with PushIfNeeded() from the device."""
-    for p in self._pushed_files:
-      self.RunShellCommand('rm -r %s' % p, timeout_time=2 * 60)
+    if self._pushed_files:
+      # Toolbox rm stops at the first path it fails to remove, so each path is
+      # removed on its own, still within a single shell command.
+      paths = []
+      for path in self._pushed_files:
+        if path not in paths:
+          paths.append(path)
+      self.RunShellCommand('for p in %s; do rm -r $p; done' % ' '.join(paths),
+                           timeout_time=2 * 60)
+      self._pushed_files = []
 
   def ListPathContents(self, path):
     """Lists files in all subdirectories of |path|.
@@ -854,18 +1449,15 @@ class AndroidCommands(object):
     Returns:
       A dict of {"name": (size, lastmod), ...}.
     """
-    # Example output:
-    # /foo/bar:
-    # -rw-r----- 1 user group   102 2011-05-12 12:29:54.131623387 +0100 baz.txt
-    re_file = re.compile('^-(?P<perms>[^\s]+)\s+'
-                         '(?P<user>[^\s]+)\s+'
-                         '(?P<group>[^\s]+)\s+'
-                         '(?P<size>[^\s]+)\s+'
-                         '(?P<date>[^\s]+)\s+'
-                         '(?P<time>[^\s]+)\s+'
-                         '(?P<filename>[^\s]+)$')
+    if self._has_find_printf is None:
+      self._has_find_printf = self.RunShellCommand(
+          'find / -prune -printf "%p\\n"') == ['/']
+    if self._has_find_printf:
+      return _GetFilesFromFindOutput(
+          path, self.RunShellCommandStream(
+              'find %s -type f -printf "%%s %%T@ %%p\\n"' % path))
     return _GetFilesFromRecursiveLsOutput(
-        path, self.RunShellCommand('ls -lR %s' % path), re_file,
+        path, self.RunShellCommandStream('ls -lR %s' % path), _LS_LR_RE,
         self.GetUtcOffset())
 
   def GetUtcOffset(self):
@@ -887,12 +1479,8 @@ class AndroidCommands(object):
     properties = ''
     if self._adb.Pull(LOCAL_PROPERTIES_PATH, temp_props_file.name):
       properties = file(temp_props_file.name).read()
-    re_search = re.compile(r'^\s*' + re.escape(JAVA_ASSERT_PROPERTY) +
-                           r'\s*=\s*all\s*$', re.MULTILINE)
-    if enable != bool(re.search(re_search, properties)):
-      re_replace = re.compile(r'^\s*' + re.escape(JAVA_ASSERT_PROPERTY) +
-                              r'\s*=\s*\w+\s*$', re.MULTILINE)
-      properties = re.sub(re_replace, '', properties)
+    if enable != bool(_JAVA_ASSERT_SEARCH_RE.search(properties)):
+      properties = _JAVA_ASSERT_REPLACE_RE.sub('', properties)
       if enable:
         properties += '\n%s=all\n' % JAVA_ASSERT_PROPERTY
 
@@ -901,40 +1489,51 @@ class AndroidCommands(object):
 
     # Next, check the current runtime value is what we need, and
     # if not, set it and report that a reboot is required.
-    was_set = 'all' in self.RunShellCommand('getprop ' + JAVA_ASSERT_PROPERTY)
+    was_set = self._GetAllProps().get(JAVA_ASSERT_PROPERTY) == 'all'
     if was_set == enable:
       return False
 
-    self.RunShellCommand('setprop %s "%s"' % (JAVA_ASSERT_PROPERTY,
-                                              enable and 'all' or ''))
+    value = enable and 'all' or ''
+    self.RunShellCommand('setprop %s "%s"' % (JAVA_ASSERT_PROPERTY, value))
+    self._all_props[JAVA_ASSERT_PROPERTY] = value
     return True
 
+  def _GetAllProps(self):
+    """Returns a dict of all the system properties.
+
+    The properties are fetched with a single `getprop` the first time, and
+    until the device reboots. The read-only properties can't change meanwhile,
+    and the others are only ever changed here through SetJavaAssertsEnabled().
+    """
+    if self._all_props is None:
+      self._all_props = dict(_GETPROP_RE.findall(
+          '\n'.join(self.RunShellCommand('getprop'))))
+    return self._all_props
+
+  def _GetProp(self, name):
+    """Returns the non-empty value of the read-only system property |name|."""
+    value = self._GetAllProps().get(name)
+    assert value
+    return value
+
   def GetBuildId(self):
     """Returns the build ID of the system (e.g. JRM79C)."""
-    build_id = self.RunShellCommand('getprop ro.build.id')[0]
-    assert build_id
-    return build_id
+    return self._GetProp('ro.build.id')
 
   def GetBuildType(self):
     """Returns the build type of the system (e.g. eng)."""
-    build_type = self.RunShellCommand('getprop ro.build.type')[0]
-    assert build_type
-    return build_type
+    return self._GetProp('ro.build.type')
 
   def GetDescription(self):
     """Returns the description of the system.
 
     For example, "yakju-userdebug 4.1 JRN54F 364167 dev-keys".
     """
-    description = self.RunShellCommand('getprop ro.build.description')[0]
-    assert description
-    return description
+    return self._GetProp('ro.build.description')
 
   def GetProductModel(self):
     """Returns the name of the product model (e.g. "Galaxy Nexus") """
-    model = self.RunShellCommand('getprop ro.product.model')[0]
-    assert model
-    return model
+    return self._GetProp('ro.product.model')
 
   def StartMonitoringLogcat(self, clear=True, logfile=None, filters=None):
     """Starts monitoring the output of logcat, for use with WaitForLogMatch.
@@ -955,24 +1554,28 @@ class AndroidCommands(object):
     else:
       args.append('*:v')
 
-    if logfile:
-      logfile = NewLineNormalizer(logfile)
-
+    if self._logcat:
+      self._logcat.Close()
     # Spawn logcat and syncronize with it.
     for _ in range(4):
-      self._logcat = pexpect.spawn(constants.ADB_PATH, args, timeout=10,
-                                   logfile=logfile)
+      self._logcat = _LogcatReader(args, logfile=logfile)
       self.RunShellCommand('log startup_sync')
-      if self._logcat.expect(['startup_sync', pexpect.EOF,
-                              pexpect.TIMEOUT]) == 0:
-        break
-      self._logcat.close(force=True)
+      try:
+        t0 = time.time()
+        line = ''
+        while line is not None and 'startup_sync' not in line:
+          line = self._logcat.ReadLine(t0 + 10 - time.time())
+        if line is not None:
+          break
+      except errors.WaitForResponseTimedOutError:
+        pass
+      self._logcat.Close()
     else:
-      logging.critical('Error reading from logcat: ' + str(self._logcat.match))
+      logging.critical('Error reading from logcat: startup_sync was not logged')
       sys.exit(1)
 
   def GetMonitoredLogCat(self):
-    """Returns an "adb logcat" command as created by pexpected.spawn."""
+    """Returns the _LogcatReader of the "adb logcat" being monitored."""
     if not self._logcat:
       self.StartMonitoringLogcat(clear=False)
     return self._logcat
@@ -997,43 +1600,45 @@ class AndroidCommands(object):
       is matched first.
     """
     logging.info('<<< Waiting for logcat:' + str(success_re.pattern))
+    # Lines which can't match either pattern are skipped without searching.
+    success_anchor = _LiteralAnchor(success_re)
+    error_anchor = error_re and _LiteralAnchor(error_re)
     t0 = time.time()
+    if not self._logcat:
+      self.StartMonitoringLogcat(clear)
     while True:
-      if not self._logcat:
-        self.StartMonitoringLogcat(clear)
+      # Lines which were already read are still returned once out of time.
+      time_remaining = max(t0 + timeout - time.time(), 0)
       try:
-        while True:
-          # Note this will block for upto the timeout _per log line_, so we need
-          # to calculate the overall timeout remaining since t0.
-          time_remaining = t0 + timeout - time.time()
-          if time_remaining < 0: raise pexpect.TIMEOUT(self._logcat)
-          self._logcat.expect(PEXPECT_LINE_RE, timeout=time_remaining)
-          line = self._logcat.match.group(1)
-          if error_re:
-            error_match = error_re.search(line)
-            if error_match:
-              return None
-          success_match = success_re.search(line)
-          if success_match:
-            return success_match
-          logging.info('<<< Skipped Logcat Line:' + str(line))
-      except pexpect.TIMEOUT:
+        line = self._logcat.ReadLine(time_remaining)
+      except errors.WaitForResponseTimedOutError:
         raise pexpect.TIMEOUT(
             'Timeout (%ds) exceeded waiting for pattern "%s" (tip: use -vv '
             'to debug)' %
             (timeout, success_re.pattern))
-      except pexpect.EOF:
+      if line is None:
         # It seems that sometimes logcat can end unexpectedly. This seems
         # to happen during Chrome startup after a reboot followed by a cache
-        # clean. I don't understand why this happens, but this code deals with
-        # getting EOF in logcat.
+        # clean. I don't understand why this happens, but this code deals
+        # with getting EOF in logcat.
         logging.critical('Found EOF in adb logcat. Restarting...')
-        # Rerun spawn with original arguments. Note that self._logcat.args[0] is
-        # the path of adb, so we don't want it in the arguments.
-        self._logcat = pexpect.spawn(constants.ADB_PATH,
-                                     self._logcat.args[1:],
-                                     timeout=self._logcat.timeout,
+        # Rerun logcat with original arguments.
+        self._logcat.Close()
+        self._logcat = _LogcatReader(self._logcat.args,
                                      logfile=self._logcat.logfile)
+        continue
+      if (success_anchor and success_anchor not in line and
+          (not error_re or error_anchor and error_anchor not in line)):
+        logging.info('<<< Skipped Logcat Line:' + str(line))
+        continue
+      if error_re:
+        error_match = error_re.search(line)
+        if error_match:
+          return None
+      success_match = success_re.search(line)
+      if success_match:
+        return success_match
+      logging.info('<<< Skipped Logcat Line:' + str(line))
 
   def StartRecordingLogcat(self, clear=True, filters=['*:v']):
     """Starts recording logcat output to eventually be saved as a string.
@@ -1047,11 +1652,25 @@ class AndroidCommands(object):
     """
     if clear:
       self._adb.SendCommand('logcat -c')
-    logcat_command = 'adb %s logcat -v threadtime %s' % (self._adb._target_arg,
-                                                         ' '.join(filters))
-    self._logcat_tmpoutfile = tempfile.TemporaryFile(bufsize=0)
-    self.logcat_process = subprocess.Popen(logcat_command, shell=True,
-                                           stdout=self._logcat_tmpoutfile)
+    logcat_command = ([constants.ADB_PATH] +
+                      shlex.split(self._adb._target_arg) +
+                      ['logcat', '-v', 'threadtime'] + list(filters))
+    self.logcat_process = subprocess.Popen(logcat_command,
+                                           stdout=subprocess.PIPE, bufsize=0)
+    # Keep the output in memory rather than in a temporary file, reading it as
+    # it comes so that logcat never blocks on a full pipe.
+    self._logcat_output = []
+    def _ReadLogcat(stdout, output):
+      try:
+        for chunk in iter(lambda: os.read(stdout.fileno(), 65536), ''):
+          output.append(chunk)
+      finally:
+        stdout.close()
+    self._logcat_reader = threading.Thread(
+        target=_ReadLogcat,
+        args=(self.logcat_process.stdout, self._logcat_output))
+    self._logcat_reader.daemon = True
+    self._logcat_reader.start()
 
   def StopRecordingLogcat(self):
     """Stops an existing logcat recording subprocess and returns output.
@@ -1068,10 +1687,11 @@ class AndroidCommands(object):
     if self.logcat_process.poll() is None:
       self.logcat_process.kill()
     self.logcat_process.wait()
+    self._logcat_reader.join(1)
     self.logcat_process = None
-    self._logcat_tmpoutfile.seek(0)
-    output = self._logcat_tmpoutfile.read()
-    self._logcat_tmpoutfile.close()
+    output = ''.join(self._logcat_output)
+    self._logcat_output = None
+    self._logcat_reader = None
     return output
 
   def SearchLogcatRecord(self, record, message, thread_id=None, proc_id=None,
@@ -1099,14 +1719,17 @@ class AndroidCommands(object):
     if proc_id:
       proc_id = str(proc_id)
     results = []
-    reg = re.compile('(\d+)\s+(\d+)\s+([A-Z])\s+([A-Za-z]+)\s*:(.*)$',
-                     re.MULTILINE)
-    log_list = reg.findall(record)
+    # Avoid running the re over records which can't match anyway.
+    if message not in record:
+      return results
+    log_list = _LOGCAT_SEARCH_RE.findall(record)
     for (tid, pid, log_lev, comp, msg) in log_list:
+      if message not in msg:
+        continue
       if ((not thread_id or thread_id == tid) and
           (not proc_id or proc_id == pid) and
           (not log_level or log_level == log_lev) and
-          (not component or component == comp) and msg.find(message) > -1):
+          (not component or component == comp)):
         match = dict({'thread_id': tid, 'proc_id': pid,
                       'log_level': log_lev, 'component': comp,
                       'message': msg})
@@ -1125,18 +1748,37 @@ class AndroidCommands(object):
       that process will be inserted to the front of the pid list.
     """
     pids = []
-    for line in self.RunShellCommand('ps', log_result=False):
+    for line in self._GetPsLines(process_name):
+      # Most rows don't mention the name at all, don't bother splitting them.
+      if process_name not in line:
+        continue
       data = line.split()
-      try:
-        if process_name in data[-1]:  # name is in the last column
-          if process_name == data[-1]:
-            pids.insert(0, data[1])  # PID is in the second column
-          else:
-            pids.append(data[1])
-      except IndexError:
-        pass
+      if len(data) < 2:
+        continue
+      # The name is in the last column and the PID in the second one.
+      if process_name == data[-1]:
+        pids.insert(0, data[1])
+      elif process_name in data[-1]:
+        pids.append(data[1])
     return pids
 
+  def _GetPsLines(self, process_name):
+    """Returns the lines of the ps output that may mention process_name.
+
+    The filtering is done on the device when it has a grep, so that only a
+    handful of lines go through adb. The callers still check the name column
+    themselves, since grep also matches the other columns.
+    """
+    if self._has_grep is not False and not re.search(r'["$`\\]', process_name):
+      status, output = self.GetShellCommandStatusAndOutput(
+          'ps | grep -F "%s"' % process_name)
+      # grep exits with 1 when nothing matched.
+      if status in (0, 1):
+        self._has_grep = True
+        return output
+      self._has_grep = False
+    return self.RunShellCommand('ps', log_result=False)
+
   def GetIoStats(self):
     """Gets cumulative disk IO stats since boot (for all processes).
 
@@ -1144,7 +1786,20 @@ class AndroidCommands(object):
       Dict of {num_reads, num_writes, read_ms, write_ms} or None if there
       was an error.
     """
-    for line in self.GetFileContents('/proc/diskstats', log_result=False):
+    lines = None
+    if self._has_grep is not False:
+      # Only bring back the line of the disk we are interested in.
+      status, output = self.GetShellCommandStatusAndOutput(
+          'grep " mmcblk0 " /proc/diskstats')
+      # grep exits with 1 when nothing matched.
+      if status in (0, 1):
+        self._has_grep = True
+        lines = output
+      else:
+        self._has_grep = False
+    if lines is None:
+      lines = self.GetFileContents('/proc/diskstats', log_result=False)
+    for line in lines:
       stats = io_stats_parser.ParseIoStatsLine(line)
       if stats.device == 'mmcblk0':
         return {
@@ -1175,28 +1830,33 @@ class AndroidCommands(object):
     current_smap = ''
     for line in self.GetProtectedFileContents('/proc/%s/smaps' % pid,
                                               log_result=False):
-      items = line.split()
-      # See man 5 proc for more details. The format is:
-      # address perms offset dev inode pathname
-      if len(items) > 5:
-        current_smap = ' '.join(items[5:])
-      elif len(items) > 3:
-        current_smap = ' '.join(items[3:])
-      match = re.match(MEMORY_INFO_RE, line)
-      if match:
-        key = match.group('key')
-        usage_kb = int(match.group('usage_kb'))
-        usage_dict[key] += usage_kb
-        if key not in smaps[current_smap]:
-          smaps[current_smap][key] = 0
-        smaps[current_smap][key] += usage_kb
+      # The usage lines are "key:    usage kB", see MEMORY_INFO_RE. Only the
+      # mapping headers have a space before their first ':' (or no ':').
+      key, _, usage = line.partition(':')
+      if ' ' in key:
+        items = line.split()
+        # See man 5 proc for more details. The format is:
+        # address perms offset dev inode pathname
+        if len(items) > 5:
+          current_smap = ' '.join(items[5:])
+        elif len(items) > 3:
+          current_smap = ' '.join(items[3:])
+        continue
+      if not usage.endswith(' kB'):
+        continue
+      try:
+        usage_kb = int(usage[:-len(' kB')])
+      except ValueError:
+        continue
+      usage_dict[key] += usage_kb
+      smaps[current_smap][key] = smaps[current_smap].get(key, 0) + usage_kb
     if not usage_dict or not any(usage_dict.values()):
       # Presumably the process died between ps and calling this method.
       logging.warning('Could not find memory usage for pid ' + str(pid))
 
     for line in self.GetProtectedFileContents('/d/nvmap/generic-0/clients',
                                               log_result=False):
-      match = re.match(NVIDIA_MEMORY_INFO_RE, line)
+      match = NVIDIA_MEMORY_INFO_RE.match(line)
       if match and match.group('pid') == pid:
         usage_bytes = int(match.group('usage_bytes'))
         usage_dict['Nvidia'] = int(round(usage_bytes / 1000.0))  # kB
@@ -1223,8 +1883,22 @@ class AndroidCommands(object):
     pid_list = self.ExtractPid(package)
     smaps = collections.defaultdict(dict)
 
+    # Reading the files of a pid is mostly waiting on adb, so the pids are
+    # spread over a few threads.
+    usage_per_pid = {}
+    def _GetMemoryUsageForPids(pids):
+      for pid in pids:
+        usage_per_pid[pid] = self.GetMemoryUsageForPid(pid)
+    num_threads = min(_MEMORY_USAGE_MAX_THREADS, len(pid_list))
+    threads = reraiser_thread.ReraiserThreadGroup(
+        [reraiser_thread.ReraiserThread(_GetMemoryUsageForPids,
+                                        [pid_list[i::num_threads]])
+         for i in xrange(num_threads)])
+    threads.StartAll()
+    threads.JoinAll()
+
     for pid in pid_list:
-      usage_dict_per_pid, smaps_per_pid = self.GetMemoryUsageForPid(pid)
+      usage_dict_per_pid, smaps_per_pid = usage_per_pid[pid]
       smaps[pid] = smaps_per_pid
       for (key, value) in usage_dict_per_pid.items():
         usage_dict[key] += value
@@ -1243,24 +1917,35 @@ class AndroidCommands(object):
     tcp_results = self.RunShellCommand('cat /proc/net/tcp', log_result=False)
     tcp_address = '0100007F:%04X' % device_port
     pids = []
-    for single_connect in tcp_results:
+    # Skip the header, and the connections which can't be on the port at all.
+    for single_connect in tcp_results[1:]:
+      if tcp_address not in single_connect:
+        continue
       connect_results = single_connect.split()
       # Column 1 is the TCP port, and Column 9 is the inode of the socket
       if connect_results[1] == tcp_address:
         socket_inode = connect_results[9]
         socket_name = 'socket:[%s]' % socket_inode
-        lsof_results = self.RunShellCommand('lsof', log_result=False)
-        for single_process in lsof_results:
-          process_results = single_process.split()
-          # Ignore the line if it has less than nine columns in it, which may
-          # be the case when a process stops while lsof is executing.
-          if len(process_results) <= 8:
+        # Rather than parsing the whole lsof output, look for the socket in the
+        # fd table of each process on the device, and only print the
+        # "/proc/<pid>" of the processes using it, followed by a line with
+        # their NUL separated command line.
+        process_results = self.RunShellCommand(
+            'for p in /proc/[0-9]*; do '
+            'case "$(ls -l $p/fd 2>/dev/null)" in *"%s"*) '
+            'echo $p; cat $p/cmdline 2>/dev/null; echo;; esac; done' %
+            socket_name, log_result=False)
+        lines = iter(process_results)
+        for single_process in lines:
+          # Skip anything else, e.g. errors for processes which stopped.
+          if not single_process.startswith('/proc/'):
             continue
-          # Column 0 is the executable name
-          # Column 1 is the pid
-          # Column 8 is the Inode in use
-          if process_results[8] == socket_name:
-            pids.append((int(process_results[1]), process_results[0]))
+          pid = single_process[len('/proc/'):]
+          if pid.isdigit():
+            # Like the lsof COMMAND column, use the basename of the executable.
+            cmdline = next(lines, '')
+            process_name = cmdline.split('\0', 1)[0].split('/')[-1]
+            pids.append((int(pid), process_name))
         break
     logging.info('PidsUsingDevicePort: %s', pids)
     return pids
@@ -1276,15 +1961,18 @@ class AndroidCommands(object):
     """
     assert '"' not in file_name, 'file_name cannot contain double quotes'
     try:
-      status = self._adb.SendShellCommand(
-          '\'test -e "%s"; echo $?\'' % (file_name))
-      if 'test: not found' not in status:
-        return int(status) == 0
-
-      status = self._adb.SendShellCommand(
-          '\'ls "%s" >/dev/null 2>&1; echo $?\'' % (file_name))
-      return int(status) == 0
-    except ValueError:
+      if self._has_test is None:
+        status, _ = self.GetShellCommandStatusAndOutput('test -e /')
+        # The shell exits with 127 when it can't find the command.
+        self._has_test = status != 127
+      if self._has_test:
+        command = 'test -e "%s"' % file_name
+      else:
+        command = 'ls "%s" >/dev/null 2>&1' % file_name
+      status, _ = self.GetShellCommandStatusAndOutput(command)
+      return status == 0
+    # Either means there was no usable output, e.g. "error: device not found".
+    except (ValueError, errors.DeviceUnresponsiveError):
       if IsDeviceAttached(self._device):
         raise errors.DeviceUnresponsiveError('Device may be offline.')
 
@@ -1369,10 +2057,18 @@ class NewLineNormalizer(object):
   """
   def __init__(self, output):
     self._output = output
+    self._pending = []
 
   def write(self, data):
-    data = data.replace('\r\r\n', '\n')
-    self._output.write(data)
+    # Pexpect flushes after each read, so the data of all the writes made in
+    # between is only normalized once, on flush().
+    self._pending.append(data)
 
   def flush(self):
+    data = ''.join(self._pending)
+    # Hold back trailing '\r's, they may be the start of a '\r\r\n' split
+    # across reads.
+    keep = len(data.rstrip('\r'))
+    self._pending = [data[keep:]] if keep < len(data) else []
+    self._output.write(data[:keep].replace('\r\r\n', '\n'))
     self._output.flush()
@@ -0,0 +1,205 @@
+# Copyright 2013 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for android_commands.py."""
+
+import StringIO
+import datetime
+import os
+import re
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                os.pardir))
+
+from pylib import android_commands
+
+
+# 2013-05-01 12:34:56 UTC.
+_TIMESTAMP = 1367411696
+
+
+class TestListPathContentsParsers(unittest.TestCase):
+  """Tests that the `ls -lR` and `find -printf` parsers agree."""
+
+  def _ParseLs(self, path, ls_output):
+    return android_commands._GetFilesFromRecursiveLsOutput(
+        path, ls_output, android_commands._LS_LR_RE, '+0000')
+
+  def _ParseFind(self, path, find_output):
+    return android_commands._GetFilesFromFindOutput(path, find_output)
+
+  def testDirectory(self):
+    ls_output = [
+        '-rw-rw-r-- root sdcard_rw 3 2013-05-01 12:34 a.txt',
+        'drwxrwxr-x root sdcard_rw 2013-05-01 12:34 sub',
+        '',
+        '/sdcard/foo/sub:',
+        '-rw-rw-r-- root sdcard_rw 6 2013-05-01 12:34 b.txt',
+    ]
+    find_output = [
+        '3 %d.5 /sdcard/foo/a.txt' % _TIMESTAMP,
+        '6 %d.0 /sdcard/foo/sub/b.txt' % _TIMESTAMP,
+    ]
+    lastmod = datetime.datetime(2013, 5, 1, 12, 34)
+    expected = {'a.txt': (3, lastmod), 'sub/b.txt': (6, lastmod)}
+    self.assertEqual(expected, self._ParseLs('/sdcard/foo', ls_output))
+    self.assertEqual(expected, self._ParseFind('/sdcard/foo', find_output))
+    self.assertEqual(expected, self._ParseFind('/sdcard/foo/', find_output))
+
+  def testFile(self):
+    ls_output = ['-rw-rw-r-- root sdcard_rw 3 2013-05-01 12:34 /sdcard/a.txt']
+    find_output = ['3 %d /sdcard/a.txt' % _TIMESTAMP]
+    lastmod = datetime.datetime(2013, 5, 1, 12, 34)
+    expected = {'a.txt': (3, lastmod)}
+    self.assertEqual(expected, self._ParseLs('/sdcard/a.txt', ls_output))
+    self.assertEqual(expected, self._ParseFind('/sdcard/a.txt', find_output))
+
+  def testFindSkipsErrors(self):
+    find_output = [
+        'find: /sdcard/foo/private: Permission denied',
+        '3 %d /sdcard/foo/a.txt' % _TIMESTAMP,
+    ]
+    self.assertEqual(['a.txt'],
+                     self._ParseFind('/sdcard/foo', find_output).keys())
+
+
+class TestLiteralAnchor(unittest.TestCase):
+  """Tests for android_commands._LiteralAnchor()."""
+
+  def _Anchor(self, pattern, flags=0):
+    return android_commands._LiteralAnchor(re.compile(pattern, flags))
+
+  def testLiteral(self):
+    self.assertEqual('startup_sync', self._Anchor('startup_sync'))
+    self.assertEqual('**PERFANNOTATION(Foo):',
+                     self._Anchor(r'\*\*PERFANNOTATION\(Foo\)\:(.*)'))
+
+  def testOnlyRequiredCharacters(self):
+    self.assertEqual('abc', self._Anchor('abcd?ef'))
+    self.assertEqual('bcd', self._Anchor('a.bcd'))
+    self.assertEqual('yy', self._Anchor(r'x\d+yy'))
+    self.assertEqual('', self._Anchor('abc|xyz'))
+
+  def testIgnoreCase(self):
+    self.assertEqual('', self._Anchor('hello', re.IGNORECASE))
+    self.assertEqual('', self._Anchor('(?i)hello'))
+
+  def testMatchesContainAnchor(self):
+    for pattern, line in (('Error(: .*)?$', 'I/foo( 1): Error: x'),
+                          (r'[Ff]ailed to (start|stop)', 'Failed to stop'),
+                          ('ab+c', 'abbbc')):
+      self.assertTrue(re.search(pattern, line))
+      self.assertIn(self._Anchor(pattern), line)
+
+
+class TestIterLines(unittest.TestCase):
+  """Tests for android_commands._IterLines()."""
+
+  def testLikeSplitlines(self):
+    for output in ('', 'a', 'a\n', 'a\nb', 'a\r\nb\r\n', 'a\rb\r',
+                   '\n\n', 'a\r\r\nb', '\r\n'):
+      self.assertEqual(output.splitlines(),
+                       list(android_commands._IterLines(output)), repr(output))
+
+
+class TestHasAdbPushSucceeded(unittest.TestCase):
+  """Tests for android_commands._HasAdbPushSucceeded()."""
+
+  def testSucceeded(self):
+    self.assertTrue(android_commands._HasAdbPushSucceeded(''))
+    self.assertTrue(android_commands._HasAdbPushSucceeded(
+        '3035 KB/s (12512056 bytes in 4.025s)\r\n'))
+    self.assertTrue(android_commands._HasAdbPushSucceeded(
+        'push: a -> b\n3035 KB/s (12512056 bytes in 4.025s)'))
+
+  def testFailed(self):
+    self.assertFalse(android_commands._HasAdbPushSucceeded(
+        'failed to copy \'a\' to \'b\': Permission denied\n'))
+    self.assertFalse(android_commands._HasAdbPushSucceeded(
+        '3035 KB/s (1 bytes in 4.025s)\nfailed to copy \'a\' to \'b\''))
+
+
+class TestNewLineNormalizer(unittest.TestCase):
+  """Tests for android_commands.NewLineNormalizer."""
+
+  def testSplitEndOfLine(self):
+    output = StringIO.StringIO()
+    normalizer = android_commands.NewLineNormalizer(output)
+    for data in ('a\r', '\r\nb', '\r\r', '\nc\r\r\n', 'd'):
+      normalizer.write(data)
+      normalizer.flush()
+    self.assertEqual('a\nb\nc\nd', output.getvalue())
+
+  def testWritesBeforeFlush(self):
+    output = StringIO.StringIO()
+    normalizer = android_commands.NewLineNormalizer(output)
+    normalizer.write('a\r')
+    normalizer.write('\r')
+    self.assertEqual('', output.getvalue())
+    normalizer.write('\nb\r')
+    normalizer.flush()
+    self.assertEqual('a\nb', output.getvalue())
+
+
+def _CreateAndroidCommands():
+  """Returns an AndroidCommands which doesn't talk to any device."""
+  return android_commands.AndroidCommands.__new__(
+      android_commands.AndroidCommands)
+
+
+class TestRunShellCommandBatch(unittest.TestCase):
+  """Tests for AndroidCommands.RunShellCommandBatch()."""
+
+  def testSplitsOutput(self):
+    separator = android_commands._BATCH_SEPARATOR
+    adb = _CreateAndroidCommands()
+    commands = []
+    def _RunShellCommand(command, timeout_time, log_result):
+      commands.append(command)
+      return ['a', 'b', separator, separator, 'no newline' + separator]
+    adb.RunShellCommand = _RunShellCommand
+    self.assertEqual([['a', 'b'], [], ['no newline']],
+                     adb.RunShellCommandBatch(['one', 'two', 'three']))
+    self.assertEqual(1, len(commands))
+    self.assertEqual('one; echo %s; two; echo %s; three; echo %s;' %
+                     (separator, separator, separator), commands[0])
+
+  def testTruncatedOutput(self):
+    adb = _CreateAndroidCommands()
+    adb.RunShellCommand = lambda command, timeout_time, log_result: ['a']
+    self.assertRaises(AssertionError, adb.RunShellCommandBatch, ['one'])
+
+
+class TestGetMemoryUsageForPid(unittest.TestCase):
+  """Tests for the smaps parsing of AndroidCommands.GetMemoryUsageForPid()."""
+
+  def testParsesSmaps(self):
+    contents = {
+        '/proc/1/smaps': [
+            '00400000-0040b000 r-xp 00000000 fd:01 123 /system/bin/app',
+            'Size:                 44 kB',
+            'Rss:                  12 kB',
+            'VmFlags: rd ex mr mw me dw',
+            'b0000000-b0001000 rw-p 00000000 00:00 0',
+            'Rss:                   4 kB',
+            'Nonsense:           abc kB',
+        ],
+        '/d/nvmap/generic-0/clients': [
+            'CLIENT                        PROCESS      PID        SIZE',
+            'user                          app            1       2048',
+        ],
+    }
+    adb = _CreateAndroidCommands()
+    adb.GetProtectedFileContents = (
+        lambda filename, log_result: contents[filename])
+    usage, smaps = adb.GetMemoryUsageForPid('1')
+    self.assertEqual({'Size': 44, 'Rss': 16, 'Nvidia': 2}, dict(usage))
+    self.assertEqual({'/system/bin/app': {'Size': 44, 'Rss': 12},
+                      '00:00 0': {'Rss': 4}}, dict(smaps))
+
+
+if __name__ == '__main__':
+  unittest.main()
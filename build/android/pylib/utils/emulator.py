@@ -54,7 +54,7 @@ def _KillAllEmulators():
     cmd_helper.RunCmd(['adb', '-s', emu_name, 'emu', 'kill'])
   logging.info('Emulator killing is async; give a few seconds for all to die.')
   for i in range(5):
-    if not android_commands.GetEmulators():
+    if not android_commands.GetEmulators(force=True):
       return
     time.sleep(1)
 